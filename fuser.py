@@ -7,17 +7,20 @@ are fused and validated and an output file is written. if no `-o` `--output`
 is provided, output is written to stdout
 """
 
-#NOTE so far, only major and minor versions are checked. fixes (ie, the `.1` in `v3.2.1`) are not checked
-#TODO more file-grained check of `<=` vs `<` and `>=` vs `>`
+#NOTE versions are compared on major, minor and fix numbers (ie, `v3.2.1`). anything after the fix number is ignored
 #TODO rework `rgx` for comma-separated version specs. i.e, "Pillow>2.0,3.0"
 #TODO handle recursive references to other requirements files
 #TODO add `-n` `--no_conflict_check` to turn off dependency conflict checking
 
 import os
 import re
-import math
-import argparse
+import sys
+import stat
+import mmap
+import codecs
+import functools
 import typing as t
+from collections import defaultdict
 
 # -------------------------------------
 # helpers
@@ -32,209 +35,398 @@ CWD = os.getcwd()
 
 ALLOWED_OPS = ["<","<=","==",">=",">"]
 
+STDOUT_CHUNK_SIZE = 1 << 16
+
+MMAP_THRESHOLD = 1 << 20  # input files bigger than 1MiB are mmap-ed instead of read
+
 # in: Pillow<=10.0.0 => out: ("Pillow", "<=", "10.0.0")
-rgx = re.compile(r"([A-Za-z\-]+)([<>=]*)([\d\.]*)")
+rgx = re.compile(r"^([A-Za-z\-]+)([<>=]*)([\d\.]*)", re.ASCII)
+# pip options (`--index-url`...) and VCS urls are kept as-is, like any line `rgx` doesn't match (local paths...)
+_PREFIX_RGX = re.compile(r"^(?:--|git\+)", re.ASCII)
+# lines of a requirements file, for `str` or `bytes`-like (`mmap`) contents
+_LINE_RGX = re.compile(r"[^\r\n]+")
+_LINE_RGX_BYTES = re.compile(rb"[^\r\n]+")
+# inline comments
+_COMMENT_RGX = re.compile(r"#[^#]=$", re.ASCII)
+# major, minor and fix version numbers: 10.1 => ("10", "1", None), .5 => ("", "5", None)
+_VER_RGX = re.compile(r"(\d*)(?:\.(\d+))?(?:\.(\d+))?", re.ASCII)
 
 dependency_conflict_error_msg = lambda pkg, versions: f"dependency conflict for package '{pkg}' with versions {versions}"
 
-def read_file(fp:str|os.PathLike) -> str:
-    with open(fp, mode="r") as fh:
-        return fh.read()
+# build the fused version specs of a package from its bounds, keyed by `(has floor, has roof)`
+emit_bounds = {
+    (False, False): lambda floor, roof, floor_op, roof_op: [("", "")],
+    (True, False):  lambda floor, roof, floor_op, roof_op: [(floor_op, floor)],
+    (False, True):  lambda floor, roof, floor_op, roof_op: [(roof_op, roof)],
+    (True, True):   lambda floor, roof, floor_op, roof_op: [(floor_op, floor), (roof_op, roof)],
+}
+
+def stat_or_none(fp:str|os.PathLike) -> os.stat_result|None:
+    """
+    `os.stat` a file, returning None if it can't be accessed (like `os.path.isfile` returns False)
+    """
+    try:
+        return os.stat(fp)
+    except (OSError, ValueError):
+        return None
+
+def read_file(fp:str|os.PathLike, st:os.stat_result|None=None) -> str|mmap.mmap:
+    """
+    read a file with a single sized `os.read`, skipping the buffered text
+    layer of `open()` and the extra syscalls it does on small files.
+    files bigger than `MMAP_THRESHOLD` are memory-mapped instead of being copied
+    into a `str`: the caller is responsible for closing the returned `mmap`.
+    :param st: the result of a previous `os.stat` on `fp`, used to size the read without another `fstat`
+    """
+    fd = os.open(fp, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+    try:
+        size = (st if st is not None else os.fstat(fd)).st_size
+        if size > MMAP_THRESHOLD:
+            # the mmap keeps its own reference to the file: `fd` can be closed
+            return mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        buf = os.read(fd, size)
+        # short read: keep reading until EOF
+        if len(buf) < size:
+            chunks = [buf]
+            read = len(buf)
+            while read < size:
+                chunk = os.read(fd, size - read)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                read += len(chunk)
+            buf = b"".join(chunks)
+    finally:
+        os.close(fd)
+    # `utf-8-sig` drops the BOM some editors write at the start of the file
+    return buf.decode("utf-8-sig")
 
 def write_file(fp:str, contents:str) -> None:
-    with open(fp, mode="w") as fh:
-        fh.write(contents)
+    """
+    encode `contents` once and write it with raw `os.write` calls,
+    bypassing the text and buffered layers of `open()`.
+    """
+    data = memoryview(contents.encode("utf-8"))
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_CLOEXEC", 0)
+    fd = os.open(fp, flags, 0o666)
+    try:
+        # `os.write` may write less than asked
+        while len(data):
+            written = os.write(fd, data)
+            data = data[written:]
+    finally:
+        os.close(fd)
+    return
+
+def write_stdout(lines:t.Iterable[str]) -> None:
+    """
+    write `lines` to stdout in batches of about `STDOUT_CHUNK_SIZE` characters (or the
+    block size of stdout, if bigger), instead of one write per line or one huge write.
+    batches are written to the binary `sys.stdout.buffer`, encoded with the encoding
+    and error handler of `sys.stdout`. since this skips the newline translation of the
+    text layer, lines are terminated by `os.linesep`, which is what `print` writes.
+    """
+    out = sys.stdout.buffer
+    encoding = sys.stdout.encoding or "utf-8"
+    errors = sys.stdout.errors or "strict"
+    newline = os.linesep
+    try:
+        chunk_size = max(STDOUT_CHUNK_SIZE, os.fstat(out.fileno()).st_blksize)
+    except (OSError, ValueError):
+        chunk_size = STDOUT_CHUNK_SIZE
+    batch, size = [], 0
+    for line in lines:
+        batch.append(line)
+        size += len(line) + 1
+        if size >= chunk_size:
+            out.write((newline.join(batch) + newline).encode(encoding, errors))
+            batch, size = [], 0
+    if len(batch):
+        out.write((newline.join(batch) + newline).encode(encoding, errors))
+    out.flush()
     return
 
-def version_number_to_float(v:str|None) -> float:
-    return float(re.search("^\d+\.\d+", v)[0]) if v is not None else v
+# version strings repeat massively across requirements files: cache the conversions
+@functools.lru_cache(maxsize=4096)
+def version_number_to_tuple(v:str|None) -> t.Tuple[int, int, int]|None:
+    """
+    10.1 => (10, 1, 0). versions are padded to 3 numbers so that they compare
+    like version numbers, not like floats (1.10 > 1.9, 1.1 == 1.1.0).
+    tuples are only used for comparisons: the original string is what gets written out.
+    missing numbers count as 0 (".5" => (0, 5, 0)). None is only returned for an empty version.
+    """
+    if not v:
+        return None
+    # every group of `_VER_RGX` is optional: it matches any string
+    return tuple(int(n or 0) for n in _VER_RGX.match(v).groups())
 
 # -------------------------------------
 # cli stuff
 
 def init_cli():
+    # imported here: `argparse` is only needed for `-h` and badly formed command lines (see `parse_argv`)
+    import argparse
     parser = argparse.ArgumentParser('fuser', description="a small CLI to fuse multiple python requirements files into a single one, detecting dependendy conflicts along the way.")
     parser.add_argument("-i", "--input", required=True, help="relative or absolute path to requirements files. pipe '|' separated if many are provided")
     parser.add_argument("-o", "--output", help="relative or absolute path to output requirements file. if none is provided, will output to stdout")
     parser.add_argument("-w", "--overwrite", action="store_true", default=False, help="overwrite output file. defaults to false")
     return parser
 
+def parse_argv(argv:t.List[str]) -> t.Tuple[str, str|None, bool]:
+    """
+    parse the command line without importing `argparse`, which is noticeable at startup
+    when `fuser` is scripted. anything this small parser doesn't handle (`-h`, unknown
+    or missing arguments, `--input=...`) is handed over to the `argparse` parser
+    built by `init_cli`, so that the help and error messages are unchanged.
+    :param argv: the command line arguments, without the program name
+    :returns: (input, output, overwrite)
+    """
+    _input, output, overwrite = None, None, False
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        has_value = i + 1 < len(argv) and not argv[i+1].startswith("-")
+        if arg in ("-i", "--input") and has_value:
+            _input = argv[i+1]
+            i += 2
+        elif arg in ("-o", "--output") and has_value:
+            output = argv[i+1]
+            i += 2
+        elif arg in ("-w", "--overwrite"):
+            overwrite = True
+            i += 1
+        else:
+            break
+    if i < len(argv) or _input is None:
+        args = init_cli().parse_args(argv)
+        return args.input, args.output, args.overwrite
+    return _input, output, overwrite
+
 
-def sanitize_arguments(inputs: t.List[str], output:str|None, overwrite:bool) -> t.Tuple[t.List[os.PathLike], os.PathLike|None]:
+def sanitize_arguments(inputs: t.List[str], output:str|None, overwrite:bool) -> t.Tuple[t.Dict[os.PathLike, os.stat_result], os.PathLike|None]:
     """
     check for errors in useer input + replace user-inputted paths by absolute paths.
+    input paths are returned with their `os.stat` result, so that `read_file` doesn't need to stat them again.
     """
-    input_sanitized = []
+    input_sanitized = {}
     for _in in inputs:
         fp = os.path.join(CWD, _in)
-        if not os.path.isfile(fp):
+        st = stat_or_none(fp)
+        if st is None or not stat.S_ISREG(st.st_mode):
             raise FileNotFoundError(f"input file '{_in}' not found (absolute path: '{fp}')")
-        input_sanitized.append(fp)
+        input_sanitized[fp] = st
     output_sanitized = None
     if output is not None:
         output_sanitized = os.path.join(CWD, output)
-        if os.path.isfile(output_sanitized) and not overwrite:
-            raise FileExistsError(f"output file '{output}' aldready exists. use -w --overwrite to bypass. (absolute path: '{output_sanitized}')")
+        if not overwrite:
+            st = stat_or_none(output_sanitized)
+            if st is not None and stat.S_ISREG(st.st_mode):
+                raise FileExistsError(f"output file '{output}' aldready exists. use -w --overwrite to bypass. (absolute path: '{output_sanitized}')")
     return input_sanitized, output_sanitized
 
 # -------------------------------------
 # pipeline
 
-def parse_requirements(t:str) -> t.List[t.Tuple[str, str, str]]:
+def split_lines(contents:str|mmap.mmap) -> t.Iterator[str]:
     """
-    parse a requirements file into a list of strings
-    :param t: the contents of a requirements file
+    yield the non-empty lines of a requirements file, as returned by `read_file`.
+    `str` and `mmap` contents are both split on `\n`, `\r\n` and `\r` only, so that the
+    result is the same whatever the size of the file. `mmap`s are decoded line by line
+    instead of being copied whole into a `str`.
+    """
+    if isinstance(contents, str):
+        for match in _LINE_RGX.finditer(contents):
+            yield match.group()
+    else:
+        # skip the BOM some editors write at the start of the file, like `read_file` does
+        start = len(codecs.BOM_UTF8) if contents[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8 else 0
+        for match in _LINE_RGX_BYTES.finditer(contents, start):
+            yield match.group().decode("utf-8")
+
+def parse_requirements(t:str|mmap.mmap) -> t.Tuple[t.List[str], t.List[str], t.List[str]]:
+    """
+    parse a requirements file into 3 parallel lists of strings
+    :param t: the contents of a requirements file, as returned by `read_file`
     :returns:
-        [ ("package", "operator?", "version?") ]
-        ex: [('yapf', '==', '0.3.1'), ('timm', '', '')]
+        ( ["package"], ["operator?"], ["version?"] )
+        ex: (['yapf', 'timm'], ['==', ''], ['0.3.1', ''])
+    """
+    # bound methods are looked up once instead of once per line
+    prefix_match = _PREFIX_RGX.match
+    main_match = rgx.match
+    comment_sub = _COMMENT_RGX.sub
+    names, ops, versions = [], [], []
+    add_name, add_op, add_version = names.append, ops.append, versions.append
+    for line in split_lines(t):
+        # whitespace-only lines and indented comments are skipped too
+        line = line.strip()
+        if not line or line[0] == "#":
+            continue
+        line = comment_sub("", line)
+        match = None if prefix_match(line) else main_match(line)
+        if match is None:
+            add_name(line)
+            add_op("")
+            add_version("")
+        else:
+            add_name(match[1])
+            add_op(match[2])
+            add_version(match[3])
+    return names, ops, versions
+
+def parse_read_file(contents:str|mmap.mmap) -> t.Tuple[t.List[str], t.List[str], t.List[str]]:
+    """
+    `parse_requirements` on the output of `read_file`, closing it if it's an `mmap`, even if parsing fails.
     """
-    reqs = []
-    for line in t.split("\n"):
-        if len(line) and not line.startswith("#"):
-            line = re.sub(r"#[^#]=$", "", line)
-            if re.search(r"^(--|git\+)", line):
-                reqs.append(( line, "", "" ))
-            else:
-                match = rgx.search(line)
-                reqs.append(( match[1], match[2], match[3] ))
-    return reqs
+    try:
+        return parse_requirements(contents)
+    finally:
+        if isinstance(contents, mmap.mmap):
+            contents.close()
 
 
 def fuser(
-    reqs_list: t.List[ t.List[ t.Tuple[str, str, str] ] ]
-) -> t.Dict[str, t.List[ t.Tuple[str, float] ]]:
+    reqs_list: t.List[ t.Tuple[t.List[str], t.List[str], t.List[str]] ]
+) -> t.Dict[str, t.List[ t.Tuple[str, str] ]]:
     """
     fuse requirements file and detect version errors, if any
 
     :example:
     >>> reqs_list = [
-    ...     [('wandb', '', ''), ('pytorch', '>=', '2.2')],
-    ...     [('wandb', '', ''), ('pytorch', '<=', '3.0'), ('editdistance', '==', '3.2')]
+    ...     (['wandb', 'pytorch'], ['', '>='], ['', '2.2']),
+    ...     (['wandb', 'pytorch', 'editdistance'], ['', '<=', '=='], ['', '3.0', '3.2'])
     ... ]
     >>> fuser(reqs_list)
     ... # returns
     ... {
     ...     'wandb': [('', '')],
-    ...     'pytorch': [('>=', 2.2), ('<=', 3.0)],
-    ...     'editdistance':  [('==', 3.2)]
+    ...     'pytorch': [('>=', '2.2'), ('<=', '3.0')],
+    ...     'editdistance':  [('==', '3.2')]
     ... }
 
     :param reqs_list: list of requirements returned by `parse_requirements`.parse_requirements
     :returns: fused requirements, as a dict
     """
-    # all individidual packages, without version numbers
-    pkgs = set([
-        item[0]
-        for reqs in reqs_list
-        for item in reqs
-    ])
+    # a single file where each package appears once: nothing to fuse or resolve
+    if len(reqs_list) == 1:
+        pkgs, ops, vers = reqs_list[0]
+        if len(set(pkgs)) == len(pkgs):
+            return {
+                pkg: [( op, version )] if len(version) else [("", "")]
+                for (pkg, op, version) in zip(pkgs, ops, vers)
+            }
+
+    # fused files usually overlap a lot (base + dev + test requirements...):
+    # keep each `(package, operator, version)` only once, in order of first appearance
+    unique_reqs = dict.fromkeys(
+        req
+        for (pkgs, ops, vers) in reqs_list
+        for req in zip(pkgs, ops, vers)
+    )
+
+    # group all requirements by package in a single pass:
+    # { package: [("comparison operator", version tuple, "version")] }, in order of first appearance
+    grouped: t.Dict[str, t.List[t.Tuple[str, t.Tuple[int, int, int], str]]] = defaultdict(list)
+    for (pkg, op, version) in unique_reqs:
+        versions = grouped[pkg]
+        if len(version):  # only add item if there's a version number
+            versions.append(( op, version_number_to_tuple(version), version ))
+
     # packages mapped to list of ("comparison operator", "version")
     pkgs_to_versions = {}
 
-    for pkg in pkgs:
-        # a list of `("comparison operator", version)`
-        versions: t.List[t.Tuple[str, float]] = [
-            ( item[1], version_number_to_float(item[2]) )
-            for reqs in reqs_list
-            for item in reqs
-            if item[0] == pkg
-            and len(item[2])  #  only add item if there's a version number
-        ]
-
-        # more than 1 version for pkg => resolve dependency errors
-        if len(versions) == 0:
-            versions = [("", "")]
-        elif len(versions) == 1:
-            versions = versions  # useless but whatever
+    for pkg, versions in grouped.items():
+        # 0 or 1 version for pkg => nothing to resolve
+        if len(versions) <= 1:
+            pkgs_to_versions[pkg] = [ (op, version) for (op, _, version) in versions ] or [("", "")]
+            continue
 
         # there are several versions specifications for the same package. find a version specification that satistifes all individual specs.
         # this is done by computing, for each version spec, a range of [min, max] allowed versions, and then computing the intersection of all those ranges. if no valid intersection is found, there is a conflict
-        else:
-            # dict of { operator: [sorted list of versions for that operator] }
-            versions_by_op = {
-                op: sorted(_v for (_op,_v) in versions if _op==op)
-                for (op,v) in versions
-            }
-
-            # match each operator to an allowed range of versions
-            op_range = {}
-            for op, versions in versions_by_op.items():
-                if op in ["<=", "<"]:
-                    op_range[op] = [0, versions[0]]
-                elif op in [">=", ">"]:
-                    op_range[op] = [versions[-1], math.inf]
-                elif op == "==" and len(set(versions)) > 1:
-                    raise DependencyConflictError(dependency_conflict_error_msg(pkg, versions))
-                elif op == "==":
-                    op_range[op] = [versions[0], versions[0]]
-                else:
-                    raise UnsupportedOperatorError(f"unsupported operator {op}. epected one of {alowed_ops}")
-
-            # compute an intersection between all ranges
-            roof  = max(_range[1] for _range in  op_range.values())
-            floor = min(_range[0] for _range in op_range.values())
-
-            if roof < floor:
-                raise DependencyConflictError(dependency_conflict_error_msg(pkg, versions))
-
-            versions = []
-            if roof == math.inf:
-                versions = (
-                    [(">=", floor)] if ">=" in op_range.keys() and floor == op_range[">="]
-                    else [(">", floor)]
-                )
-            elif floor == 0:
-                versions = (
-                    [("<=", roof)] if "<=" in op_range.keys() and roof == op_range["<="]
-                    else [("<", roof)]
-                )
-            else:
-                versions = [(">=", floor), ("<=", roof)]
+        #
+        # each spec allows a range of versions: `<=`/`<` => [-, v], `>=`/`>` => [v, -], `==` => [v, v].
+        # the intersection of all ranges is [max of lower bounds, min of upper bounds], computed in a single pass.
+        # `None` means there is no bound on that side. strict operators win when several specs share the same bound.
+        # bounds are compared as tuples, but the version strings of the specs they come from are kept for output
+        floor, floor_op, floor_str = None, ">=", ""
+        roof, roof_op, roof_str = None, "<=", ""
+        for (op, v, v_str) in versions:
+            if op == ">=" or op == ">" or op == "==":
+                if floor is None or v > floor or (v == floor and op == ">"):
+                    floor, floor_op, floor_str = v, (">" if op == ">" else ">="), v_str
+            if op == "<=" or op == "<" or op == "==":
+                if roof is None or v < roof or (v == roof and op == "<"):
+                    roof, roof_op, roof_str = v, ("<" if op == "<" else "<="), v_str
+            elif op not in ALLOWED_OPS:
+                raise UnsupportedOperatorError(f"unsupported operator {op}. expected one of {ALLOWED_OPS}")
+
+        if floor is not None and roof is not None:
+            if roof < floor or (roof == floor and (floor_op == ">" or roof_op == "<")):
+                raise DependencyConflictError(dependency_conflict_error_msg(pkg, [ (op, v_str) for (op, _, v_str) in versions ]))
+            if roof == floor:
+                pkgs_to_versions[pkg] = [("==", floor_str)]
+                continue
+
+        versions = emit_bounds[(floor is not None, roof is not None)](floor_str, roof_str, floor_op, roof_op)
         pkgs_to_versions[pkg] = versions
     return pkgs_to_versions
 
-def to_string(reqs_obj: t.Dict[str, t.List[ t.Tuple[str, float] ]]) -> str:
+def iter_lines(reqs_obj: t.Dict[str, t.List[ t.Tuple[str, str] ]]) -> t.Iterator[str]:
+    """
+    yield the lines of the requirements file described by the object returned by `fuser`,
+    one package per line, without line terminators.
+    """
+    for pkg, op_version in reqs_obj.items():
+        yield f"{pkg}{','.join(f'{op}{version}' for (op, version) in op_version)}"
+
+def to_string(reqs_obj: t.Dict[str, t.List[ t.Tuple[str, str] ]]) -> str:
     """
-    stringify the requirements object returned by `fuser` into a valid requirements-file-like string
+    stringify the requirements object returned by `fuser` into a valid requirements-file-like string.
+    lines are formatted by `iter_lines`, and each line, including the last one, ends with a newline.
 
     :example:
     >>> reqs_obj = {
     ...     'wandb': [('', '')],
-    ...     'pytorch': [('>=', 2.2), ('<=', 3.0)],
-    ...     'editdistance':  [('==', 3.2)]
+    ...     'pytorch': [('>=', '2.2'), ('<=', '3.0')],
+    ...     'editdistance':  [('==', '3.2')]
     ... }
     >>> to_string(reqs_obj)
-    ... # returns
-    ... wandb
-    ... pytorch>=2.2,<=3.0
-    ... editdistance==3.2
+    'wandb\npytorch>=2.2,<=3.0\neditdistance==3.2\n'
     """
-    return "\n".join(
-        f"{pkg}{','.join(f'{op}{version}' for (op, version) in op_version)}"
-        for pkg, op_version in reqs_obj.items()
-    )
+    return "\n".join(iter_lines(reqs_obj)) + "\n" if len(reqs_obj) else ""
 
 # -------------------------------------
 # tadaaaaaaa
 
 if __name__ == "__main__":
-    parser = init_cli()
-    args = parser.parse_args()
-    input_reqs_files = [ i.strip() for i in args.input.split("|") ]
-    output = args.output
-    overwrite = args.overwrite
+    _input, output, overwrite = parse_argv(sys.argv[1:])
+    input_reqs_files = [ i.strip() for i in _input.split("|") ]
 
     # will raise if arguments are invalid
-    input_reqs_file, output = sanitize_arguments(input_reqs_files, output, overwrite)
+    input_reqs_files, output = sanitize_arguments(input_reqs_files, output, overwrite)
 
-    input_requirements = [ read_file(reqs_file) for reqs_file in input_reqs_files ]
-    input_requirements = [ parse_requirements(reqs) for reqs in input_requirements ]
+    if len(input_reqs_files) == 1:
+        # a single file: no need to pay for `concurrent.futures` imports and a thread pool
+        [(reqs_file, st)] = input_reqs_files.items()
+        input_requirements = [ parse_read_file(read_file(reqs_file, st)) ]
+    else:
+        # files are independent and the GIL is released during `read()`: read them concurrently,
+        # and parse each file as soon as it has been read while the other reads are still running.
+        # results are stored by index to keep the order of input files.
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        input_requirements = [None] * len(input_reqs_files)
+        with ThreadPoolExecutor(max_workers=min(32, len(input_reqs_files))) as executor:
+            read_futures = {
+                executor.submit(read_file, reqs_file, st): i
+                for i, (reqs_file, st) in enumerate(input_reqs_files.items())
+            }
+            for future in as_completed(read_futures):
+                input_requirements[read_futures[future]] = parse_read_file(future.result())
     fused_reqs = fuser(input_requirements)
-    fused_reqs = to_string(fused_reqs)
 
     if output:
-        write_file(output, fused_reqs)
+        write_file(output, to_string(fused_reqs))
     else:
-        print(fused_reqs)
+        write_stdout(iter_lines(fused_reqs))
 
 